@@ -7,7 +7,10 @@ preprints, and test them against a set of keywords to try and narrow
 down which ones are good candidates for curation in BioGRID
 """
 
-import ujson
+import orjson
+import hashlib
+import shelve
+import ijson
 import requests
 import sys
 import argparse
@@ -15,10 +18,12 @@ import datetime
 import csv
 import os
 import spacy
+import nltk
 import time
 import config as cfg
 from nltk.stem.snowball import SnowballStemmer
 from collections import Counter
+from functools import lru_cache
 
 # Initialize Config Variables
 data_file = os.path.join(cfg.data["download_path"], cfg.data["data_file"])
@@ -27,39 +32,66 @@ source_url = cfg.data["source_url"]
 high_file = cfg.data["high_file"]
 med_file = cfg.data["med_file"]
 low_file = cfg.data["low_file"]
+token_cache_file = os.path.join(
+    cfg.data["download_path"], cfg.data.get("token_cache_file", "token_cache")
+)
+
+# Keyword levels, in the order matches are reported
+KEYWORD_LEVELS = ("high", "med", "low")
+
+# Bump whenever token filtering or preprocessing changes
+# so counts cached by older code are no longer used
+TOKEN_CACHE_VERSION = 1
 
 # Load Text Processing Tools
 stemmer = SnowballStemmer(language="english")
-nlp = spacy.load("en_core_web_sm")
+# Only lemmas and stop/punct flags are used, so skip the parser and NER
+nlp = spacy.load("en_core_web_sm", disable=["parser", "ner"])
+
+# Translation tables for stripping characters in a single pass
+_AUTHOR_STRIP = str.maketrans("", "", ".;,_- ")
+_HYPHEN_STRIP = str.maketrans("", "", "-")
+
+# Identifies the pipeline that produced cached token counts
+_TOKEN_CACHE_FINGERPRINT = "|".join(
+    [
+        str(TOKEN_CACHE_VERSION),
+        nlp.meta["lang"] + "_" + nlp.meta["name"],
+        nlp.meta["version"],
+        spacy.__version__,
+        nltk.__version__,
+    ]
+)
 
 
 def is_token_allowed(token):
     """ Only allow valid tokens """
-    if not token or not token.string.strip() or token.is_stop or token.is_punct:
+    if not token or not token.text.strip() or token.is_stop or token.is_punct:
         return False
     return True
 
 
+@lru_cache(maxsize=100000)
+def stem(word):
+    """ Stem a normalized word, caching results for repeated lemmas """
+    return stemmer.stem(word)
+
+
 def preprocess_token(token):
     """ Preprocess a token """
-    token = token.lemma_.strip().lower()
-    return stemmer.stem(token)
+    return stem(token.lemma_.strip().lower())
 
 
 def author_clean(author):
     """ Clean an author and return the formatted string """
-    replace = [".", ";", " ", ",", "_", "-"]
     author_split = author.strip().split(",")
     clean_author = ""
     if len(author_split) >= 2:
         last_name = author_split[0]
-        first_name = author_split[1]
-        for rep in replace:
-            first_name = first_name.replace(rep, "")
+        first_name = author_split[1].translate(_AUTHOR_STRIP)
         clean_author = last_name + " " + first_name
     else:
-        for rep in replace:
-            clean_author = author.replace(rep, "")
+        clean_author = author.translate(_HYPHEN_STRIP)
 
     return clean_author
 
@@ -72,36 +104,107 @@ def format_author_short(authors, date):
     return author
 
 
-def calculate_score_and_matching_keywords(keywords, doc_tokens, site):
+def build_keyword_weights(keyword_sets):
+    """ Map each keyword to its level rank and bounty, higher levels winning ties """
+    keyword_weights = {}
+    for rank, level in reversed(list(enumerate(KEYWORD_LEVELS))):
+        bounty = cfg.data[level + "_bounty"]
+        for keyword in keyword_sets[level]:
+            keyword_weights[keyword] = (rank, bounty)
+
+    return keyword_weights
+
+
+def calculate_score_and_matching_keywords(keyword_weights, doc_tokens):
     """ Generate a score for each paper based on occurrences of triage keywords """
     score = 0
-    matching_keywords = []
-    for keyword in keywords:
-        if keyword in doc_tokens:
-            score += doc_tokens[keyword]
-            matching_keywords.append(keyword)
+    matches = []
+    for token, count in doc_tokens.items():
+        weight = keyword_weights.get(token)
+        if weight:
+            rank, bounty = weight
+            matches.append((rank, token))
+            score += count * bounty
 
-    return sorted(matching_keywords), score
+    # Order by level, then alphabetically, with a single sort
+    matches.sort()
+
+    return [token for rank, token in matches], score
 
 
 def fetch_keyword_set(file_name):
     """ Fetch a set of keywords out of a file """
-    keywords = set()
     with open(file_name, "r") as f:
-        for line in f:
-            keywords.add(line.replace("-", "").strip())
+        lines = f.read().translate(_HYPHEN_STRIP).splitlines()
+
+    keywords = {line.strip() for line in lines}
+    keywords.discard("")
+
+    # Process each deduplicated keyword as its own document so
+    # neighbouring entries don't influence tagging or lemmas
+    keywords = frozenset(
+        preprocess_token(token)
+        for keyword_doc in nlp.pipe(keywords)
+        for token in keyword_doc
+        if is_token_allowed(token)
+    )
+
+    return keywords
+
+
+def token_cache_key(rel):
+    """ Generate a cache key tied to a paper's text and the token pipeline """
+    key = "\n".join(
+        [_TOKEN_CACHE_FINGERPRINT, rel["rel_doi"], rel["rel_title"], rel["rel_abs"]]
+    )
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
 
-    keywords = nlp(" ".join(keywords))
-    keywords = [
-        preprocess_token(token) for token in keywords if is_token_allowed(token)
-    ]
 
-    return set(keywords)
+def count_rel_tokens(rels, token_cache, processes):
+    """ Yield each rel with its token counts, reusing cached counts for seen papers """
 
+    seen_keys = set()
 
-def author_short(str1):
-    """ Generate a short author name """
-    lst = str1.split()
+    # Cached papers still pass through the pipeline, as empty
+    # text, so results keep the order of the data file
+    def texts():
+        for rel in rels:
+            key = token_cache_key(rel)
+            seen_keys.add(key)
+            cached_count = token_cache.get(key)
+            if cached_count is not None:
+                yield "", (rel, key, cached_count)
+            else:
+                text = (rel["rel_title"] + " " + rel["rel_abs"]).translate(
+                    _HYPHEN_STRIP
+                )
+                yield text, (rel, key, None)
+
+    # Stream Title and Abstract text through the spaCy
+    # pipeline in batches rather than one call per paper,
+    # spread across worker processes
+    pub_docs = nlp.pipe(texts(), as_tuples=True, batch_size=64, n_process=processes)
+    for pub_doc, (rel, key, cached_count) in pub_docs:
+        if cached_count is not None:
+            yield rel, cached_count
+            continue
+
+        token_count = Counter(
+            preprocess_token(token) for token in pub_doc if is_token_allowed(token)
+        )
+        token_cache[key] = token_count
+        yield rel, token_count
+
+    # Drop counts for papers no longer in the data file, or cached
+    # by an older pipeline, so the cache doesn't grow without bound
+    for key in token_cache.keys() - seen_keys:
+        del token_cache[key]
+
+
+@lru_cache(maxsize=50000)
+def format_author(author_name):
+    """ Generate a short, cleaned author name, caching authors seen on other papers """
+    lst = author_name.split()
     lastNameLoc = 1
     lastname = lst[-1].title()
     if lastname[0:2].lower() == "jr" or lastname[0:2].lower() == "sr":
@@ -121,9 +224,25 @@ def author_short(str1):
             else:
                 lastname = str1 + " " + lastname
 
-    # l[-1] gives last item of list l.
-    name = lastname + " " + initials
-    return name
+    # A comma in the last name splits off the rest of the name,
+    # which is squashed together the same way as in author_clean
+    lastname, comma, rest = lastname.partition(",")
+    if not comma:
+        return (lastname + " " + initials).translate(_HYPHEN_STRIP)
+
+    rest, comma, _ = rest.partition(",")
+    if not comma:
+        rest += initials
+
+    return lastname + " " + rest.translate(_AUTHOR_STRIP)
+
+
+def process_count(value):
+    """ Parse a process count argument, requiring at least one process """
+    processes = int(value)
+    if processes < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return processes
 
 
 def is_wanted_date(end_date, pub_date):
@@ -141,6 +260,7 @@ def is_wanted_date(end_date, pub_date):
 def main(args):
 
     index_increment = 30  # Number of papers per page fetched
+    write_batch_size = 500  # Number of rows buffered before writing
     header = [
         "DOI",
         "AUTHOR_SHORT",
@@ -167,7 +287,7 @@ def main(args):
         while not done:
             resp = requests.get(source_url + "/" + str(index))
             if resp.status_code == 200:
-                data = ujson.loads(resp.text)
+                data = orjson.loads(resp.content)
                 if "count" in data["messages"][0]:
                     print(
                         "INDEX "
@@ -204,88 +324,72 @@ def main(args):
 
         if len(rels) > 0:
             print("DOWNLOADED " + str(len(rels)) + " PUBS")
-            with open(data_file, "w") as f:
-                ujson.dump(rels, f)
+            with open(data_file, "wb") as f:
+                f.write(orjson.dumps(rels))
         else:
             print("No Pubs Downloaded")
             sys.exit(0)
 
-    # Load data from json data file
-    with open(data_file, "r") as f:
-        data = ujson.load(f)
-
     # Fetch Keyword Sets
     keyword_sets = {
         "high": fetch_keyword_set(high_file),
         "med": fetch_keyword_set(med_file),
         "low": fetch_keyword_set(low_file),
     }
-
-    print("Triaging: " + str(len(data)) + " preprint articles from BioRxiv and MedRxiv")
-
-    # Output Results to File
-    with open(output_file, "w") as out:
+    keyword_weights = build_keyword_weights(keyword_sets)
+    biorxiv_bounty = cfg.data["biorxiv_bounty"]
+
+    # ijson silently falls back to a much slower pure python
+    # parser when its C extension isn't available
+    if ijson.backend != "yajl2_c":
+        print("WARNING: Parsing JSON with the slow ijson " + ijson.backend + " backend")
+
+    print("Triaging preprint articles from BioRxiv and MedRxiv")
+
+    # Stream rels out of the json data file rather than
+    # loading the whole collection into memory at once
+    doc_scores = []
+    rows = []
+    with open(data_file, "rb") as f, open(
+        output_file, "w", buffering=1 << 20, newline=""
+    ) as out, shelve.open(token_cache_file) as token_cache:
+
+        # Ignore papers with no authors
+        rels = (
+            rel for doi, rel in ijson.kvitems(f, "") if rel["rel_num_authors"] != 0
+        )
+
+        # Output Results to File
         csv_out = csv.writer(out)
         csv_out.writerow(header)
-        for doi, rel in data.items():
-
-            # Ignore papers with no authors
-            if rel["rel_num_authors"] == 0:
-                continue
+        for rel, token_count in count_rel_tokens(rels, token_cache, args.processes):
 
             # Clean Author Text
             # authors = rel["rel_authors"].split(";")
             # authors = [author_clean(author) for author in authors]
             authors = []
             authors = [
-                author_clean(author_short(author["author_name"]))
-                for author in rel["rel_authors"]
+                format_author(author["author_name"]) for author in rel["rel_authors"]
             ]
 
             # Determine the score value for the document
-            # by converting Title and Abstract to Tokens
-            # and seeing how many of our keywords occur in
-            # the text
-            pub_doc = nlp(
-                rel["rel_title"].replace("-", "")
-                + " "
-                + rel["rel_abs"].replace("-", "")
-            )
-            filtered_tokens = [
-                preprocess_token(token) for token in pub_doc if is_token_allowed(token)
-            ]
-            token_count = Counter(filtered_tokens)
-
-            # Calculate the score for each set of keywords
-            high_matches, high_score = calculate_score_and_matching_keywords(
-                keyword_sets["high"], token_count, rel["rel_site"]
-            )
-            med_matches, med_score = calculate_score_and_matching_keywords(
-                keyword_sets["med"], token_count, rel["rel_site"]
-            )
-            low_matches, low_score = calculate_score_and_matching_keywords(
-                keyword_sets["low"], token_count, rel["rel_site"]
+            # by seeing how many of our keywords occur in
+            # its Title and Abstract tokens, in a single pass
+            # multiplying matches by their level's bounty
+            matching_keywords, score = calculate_score_and_matching_keywords(
+                keyword_weights, token_count
             )
 
-            # Combine keyword lists
-            matching_keywords = high_matches + med_matches + low_matches
             file_keywords = ""
             if len(matching_keywords) > 0:
                 file_keywords = "|".join(matching_keywords)
 
-            # Calculate final score by multiplying by bounties
-            score = (
-                (high_score * cfg.data["high_bounty"])
-                + (med_score * cfg.data["med_bounty"])
-                + (low_score * cfg.data["low_bounty"])
-            )
-
             # Add an extra bounty if it's a BioRxiv paper
             if rel["rel_site"].lower() == "biorxiv":
-                score += cfg.data["biorxiv_bounty"]
+                score += biorxiv_bounty
 
             # Output to File in CSV format
-            csv_out.writerow(
+            rows.append(
                 [
                     rel["rel_doi"],
                     format_author_short(authors, rel["rel_date"]),
@@ -300,7 +404,23 @@ def main(args):
                 ]
             )
 
-            print("Document Score: " + str(score))
+            if len(rows) >= write_batch_size:
+                csv_out.writerows(rows)
+                rows.clear()
+
+            doc_scores.append("Document Score: " + str(score))
+
+        csv_out.writerows(rows)
+
+    # Report scores in a single write rather than once per paper
+    if len(doc_scores) > 0:
+        print("\n".join(doc_scores))
+
+    print(
+        "Triaged: "
+        + str(len(doc_scores))
+        + " preprint articles from BioRxiv and MedRxiv"
+    )
 
 
 if __name__ == "__main__":
@@ -322,5 +442,14 @@ if __name__ == "__main__":
         "-e", "--end", type=str, default="1970-01-01", help="Date to end parsing at"
     )
 
+    # number of processes to run the spacy pipeline with
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=process_count,
+        default=os.cpu_count() or 1,
+        help="Number of processes used to tokenize papers",
+    )
+
     args = parser.parse_args()
     main(args)